@@ -1,11 +1,11 @@
 import rospy
 
-from voxseg.msg import DepthImageInfo, Classes
-from voxseg.srv import VoxelComputation
+from voxseg.msg import DepthImageInfo, CompressedDepthImageInfo, Classes
+from voxseg.srv import VoxelComputation, SparseVoxelComputation
 
 from typing import List, Dict, Union
 
-from modules.config import CLIENT_NODE, CLASS_TOPIC, IMAGE_TOPIC, VOXEL_TOPIC, VOXEL_REQUEST_SERVICE
+from modules.config import CLIENT_NODE, CLASS_TOPIC, IMAGE_TOPIC, COMPRESSED_IMAGE_TOPIC, VOXEL_TOPIC, VOXEL_REQUEST_SERVICE, SPARSE_VOXEL_REQUEST_SERVICE
 from modules.utils import *
 
 class VoxSegClient:
@@ -19,6 +19,7 @@ class VoxSegClient:
         # Important: initialize the pubs before starting to publish
         self.class_pub = rospy.Publisher(CLASS_TOPIC, Classes, queue_size=10)
         self.image_pub = rospy.Publisher(IMAGE_TOPIC, DepthImageInfo, queue_size=10)
+        self.compressed_image_pub = rospy.Publisher(COMPRESSED_IMAGE_TOPIC, CompressedDepthImageInfo, queue_size=10)
 
     def publish_depth_image(self, image, depth_map, extrinsics):
         """
@@ -39,6 +40,25 @@ class VoxSegClient:
 
         self.image_pub.publish(full_msg)
 
+    def publish_compressed_depth_image(self, image, depth_map, extrinsics):
+        """
+        Same as publish_depth_image, but sends a jpeg image and a png depth map (millimeter precision)
+        Inputs:
+            image: a numpy array containing rgb image data, shape (h,w,c), uint8
+
+            depth_map: a numpy array containing depth data in meters, size (h,w)
+
+            extrinsics: a numpy array containing camera extrinsics, size (4,4)
+
+        """
+        timestamp = rospy.Time.now()
+        full_msg = CompressedDepthImageInfo()
+        full_msg.rgb_image = get_compressed_image_msg(image, timestamp)
+        full_msg.depth_image = get_compressed_depth_msg(depth_map, timestamp)
+        full_msg.cam_extrinsics = get_cam_msg(extrinsics)
+
+        self.compressed_image_pub.publish(full_msg)
+
     def publish_class_names(self, names: Union[List[str], None]=['other'], 
                             groups:Union[Dict[str, List[str]], None]=None,
                             prompts: Union[Dict[str, List[str]], None]=None, 
@@ -97,6 +117,27 @@ class VoxSegClient:
             rospy.logerr("Service call failed: %s", e)
             return None
 
+    def request_sparse_voxel_computation(self, min_pts_in_voxel=0):
+        """
+        Like request_voxel_computation, but the server only sends the labeled voxels, which is much smaller for mostly empty worlds
+
+        Inputs:
+            min_pts_in_voxel: the minimum number of points to consider a voxel valid for inference
+        
+        Returns:
+            torch.tensor representing the voxels and torch.tensor representing the world dim
+        """
+        rospy.wait_for_service(SPARSE_VOXEL_REQUEST_SERVICE)
+        try:
+            compute_data_service = rospy.ServiceProxy(SPARSE_VOXEL_REQUEST_SERVICE, SparseVoxelComputation)
+            voxel_response = compute_data_service(min_pts_in_voxel)
+
+            voxels, world_dim = voxels_from_sparse_srv(voxel_response)
+            return voxels, world_dim
+        except rospy.ServiceException as e:
+            rospy.logerr("Service call failed: %s", e)
+            return None
+
 
 
 if __name__=='__main__':
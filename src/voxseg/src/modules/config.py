@@ -28,6 +28,7 @@ CAMS_ALIGNED = True
 
 ################# ROS INFO ####################
 IMAGE_TOPIC = 'voxseg_image_topic'
+COMPRESSED_IMAGE_TOPIC = 'voxseg_compressed_image_topic'
 CLASS_TOPIC = 'voxseg_classes_topic'
 VOXEL_TOPIC = 'voxseg_voxels_topic'
 WORLD_DIM_TOPIC = 'voxseg_world_dim_topic'
@@ -37,6 +38,7 @@ SERVER_NODE = 'voxseg_backend'
 CLIENT_NODE = 'voxseg_frontend'
 
 VOXEL_REQUEST_SERVICE = 'voxel_request'
+SPARSE_VOXEL_REQUEST_SERVICE = 'sparse_voxel_request'
 OVT_REQUEST_SERVICE = 'ovt_srv'
 
 RVIZ_NODE = 'voxseg_rviz'
@@ -14,6 +14,10 @@ class BackendData:
 
         Inputs:
             batch_size: size of data buffers. Warning: data may be lost if get_tensors is called with a higher period than batch_size
+
+        If batch_size is set and device is a cuda device, depths and extrinsics are staged in a ring of pinned host buffers,
+        and copied to the device asynchronously as they are added (see _stage). The shipped configs leave BATCH_SIZE as None,
+        so staging is only active when a batch size is configured
         """
         self.all_images = []
         self.all_depths = []
@@ -34,6 +38,15 @@ class BackendData:
         self.device = device
 
         self.image_data_start = 0
+
+        self.batch_size = batch_size
+        self.use_pinned = bool(batch_size) and torch.device(device).type == 'cuda' and torch.cuda.is_available()
+        self.staged_count = 0 # number of frames staged since the last reset_buffers
+        self.pinned_depths = None # allocated on the first frame, once the image size is known
+        if self.use_pinned:
+            self.copy_stream = torch.cuda.Stream(device=device)
+            self.slot_events = [torch.cuda.Event() for _ in range(batch_size)]
+            self.release_event = torch.cuda.Event()
     
 
     def add_depth_image(self, image, depths, rgb_extrinsics):
@@ -45,6 +58,9 @@ class BackendData:
             
             rgb_extrinsics: np array of size (4,4)
         """
+        if self.use_pinned:
+            self._prepare_staging(depths.shape)
+
         self.all_images.append(image)
         self.all_depths.append(depths)
         self.rgb_extrinsics.append(rgb_extrinsics)
@@ -53,16 +69,89 @@ class BackendData:
         self.recent_depth_data.append(depths)
         self.recent_rgb_extr.append(rgb_extrinsics)
 
+        if self.use_pinned:
+            self._stage(depths, rgb_extrinsics)
+
+    def _allocate_staging(self, depth_shape):
+        b = self.batch_size
+        self.pinned_depths = torch.empty((b, *depth_shape), dtype=torch.float32, pin_memory=True)
+        self.pinned_extr = torch.empty((b, 4, 4), dtype=torch.float32, pin_memory=True)
+        self.device_depths = torch.empty((b, *depth_shape), dtype=torch.float32, device=self.device)
+        self.device_extr = torch.empty((b, 4, 4), dtype=torch.float32, device=self.device)
+
+    def _prepare_staging(self, depth_shape):
+        """
+        Makes sure the staging rings hold frames of depth_shape, reallocating them if the image size changed.
+        Frames of different sizes can't be projected in one batch, so the size may only change while nothing is staged
+        """
+        if self.pinned_depths is not None and tuple(self.pinned_depths.shape[1:]) == tuple(depth_shape):
+            return
+
+        if self.staged_count > 0:
+            raise ValueError(f'Depth image of size {tuple(depth_shape)} does not match the staged images of size {tuple(self.pinned_depths.shape[1:])}')
+
+        if self.pinned_depths is not None:
+            # copies into and reads out of the old rings must finish before they are freed
+            for event in self.slot_events:
+                event.synchronize()
+            self.release_event.synchronize()
+
+        self._allocate_staging(depth_shape)
+
+    def _stage(self, depths, rgb_extrinsics):
+        """
+        Writes depths and rgb_extrinsics into the next slot of the pinned ring, and starts copying that slot 
+        to the device on self.copy_stream, so the transfer overlaps with decoding the next frame
+        """
+        slot = self.staged_count % self.batch_size
+        self.slot_events[slot].synchronize() # the last copy out of this slot must finish before it is overwritten
+
+        np.copyto(self.pinned_depths[slot].numpy(), depths, casting='unsafe')
+        np.copyto(self.pinned_extr[slot].numpy(), rgb_extrinsics, casting='unsafe')
+
+        with torch.cuda.stream(self.copy_stream):
+            self.copy_stream.wait_event(self.release_event) # get_tensors must be done reading the device ring
+            self.device_depths[slot].copy_(self.pinned_depths[slot], non_blocking=True)
+            self.device_extr[slot].copy_(self.pinned_extr[slot], non_blocking=True)
+            self.slot_events[slot].record(self.copy_stream)
+
+        self.staged_count += 1
+
+    def _unstage(self):
+        """
+        Returns: 
+            the staged depths (b, h, w) and extrinsics (b, 4, 4) on the device, oldest first
+        """
+        n = min(self.staged_count, self.batch_size)
+        oldest = self.staged_count % self.batch_size if self.staged_count > self.batch_size else 0
+        slots = (torch.arange(n, device=self.device) + oldest) % self.batch_size
+
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.copy_stream)
+        
+        # indexing copies out of the ring, so new frames can be staged while these are projected
+        depth_tensor = self.device_depths[slots]
+        extr_tensor = self.device_extr[slots]
+        self.release_event.record(current_stream)
+
+        return depth_tensor, extr_tensor
+
     def fill_buffers(self):
         """
         Fill the recent data buffers with all past data
         Requires: buffer_size < len(past data)
         """
         for i in range(len(self.all_images)):
+            if self.use_pinned:
+                self._prepare_staging(self.all_depths[i].shape)
+
             self.recent_image_data.append(self.all_images[i]) 
             self.recent_depth_data.append(self.all_depths[i]) 
             self.recent_rgb_extr.append(self.rgb_extrinsics[i]) 
 
+            if self.use_pinned:
+                self._stage(self.all_depths[i], self.rgb_extrinsics[i])
+
 
     def reset_buffers(self):
         """
@@ -73,6 +162,7 @@ class BackendData:
         self.recent_image_data.clear()
         self.recent_depth_data.clear()
         self.recent_rgb_extr.clear()
+        self.staged_count = 0
 
     def reset_all(self):
         """
@@ -103,7 +193,7 @@ class BackendData:
         image_tensor = world.predictor.image_list_to_tensor(self.all_images)
         extrinsics_np = np.stack(self.rgb_extrinsics)
 
-        depth_tensor = torch.from_numpy(depths_np).to(self.device)
+        depth_tensor = torch.from_numpy(depths_np).float().to(self.device)
         depth_tensor = depth_tensor.unsqueeze(1)
         extr_tensor = torch.from_numpy(extrinsics_np).float().to(self.device)
 
@@ -127,13 +217,19 @@ class BackendData:
         if len(self.recent_image_data) == 0:
             return None
 
-        depths_np = np.stack(self.recent_depth_data)
         image_tensor = world.predictor.image_list_to_tensor(list(self.recent_image_data))
-        extrinsics_np = np.stack(self.recent_rgb_extr)
 
-        depth_tensor = torch.from_numpy(depths_np).to(self.device)
+        if self.use_pinned:
+            depth_tensor, extr_tensor = self._unstage()
+        else:
+            depths_np = np.stack(self.recent_depth_data)
+            extrinsics_np = np.stack(self.recent_rgb_extr)
+
+            # float32 like the pinned ring (see _stage), so the depth dtype doesn't depend on the config
+            depth_tensor = torch.from_numpy(depths_np).float().to(self.device)
+            extr_tensor = torch.from_numpy(extrinsics_np).float().to(self.device)
+
         depth_tensor = depth_tensor.unsqueeze(1)
-        extr_tensor = torch.from_numpy(extrinsics_np).float().to(self.device)
 
         self.reset_buffers() # clear recent data, so the same data isn't projected multiple times
 
@@ -183,15 +279,13 @@ class UnalignedData(BackendData):
 
     def get_tensors(self, world):
         
-        if tensors is not None:
-            image_tensor, depth_tensor, rgb_extr_tensor = tensors
-        else:
+        if len(self.recent_depth_extr) == 0:
             return None
 
         depth_extr_np = np.stack(self.recent_depth_extr)
         depth_extr_tensor = torch.from_numpy(depth_extr_np).float().to(self.device)
 
         tensors = super().get_tensors(world) # MUST HAPPEN AFTER (spooky inheritance stuff)
-        self.reset_buffers()
+        image_tensor, depth_tensor, rgb_extr_tensor = tensors
 
         return image_tensor, depth_tensor, rgb_extr_tensor, depth_extr_tensor
\ No newline at end of file
@@ -62,7 +62,7 @@ class OVTDataInterface:
 
         self.tick = 0
         self.rate = rospy.get_param('/ovt/COMPUTE_PERIOD')
-        self.classes = list(rospy.get_param('/ovt/CLASSES'))
+        self.classes = list(map(str, rospy.get_param('/ovt/CLASSES'))) # yaml may not give strings, so coerce once here
         self.base_name = rospy.get_param('/ovt/BASE_NAME')
         self.use_large = rospy.get_param('/ovt/USE_LARGE')
 
@@ -110,7 +110,6 @@ class OVTDataInterface:
         
         # Update from the most recent tensors 
         images_msg = list(images)
-        classes = [str(c) for c in classes]
         images = torch_from_img_array_msg(images_msg).float().to(self.device)
 
 
@@ -195,7 +194,7 @@ class OVTDataInterface:
         self.publish_probs_and_tfs(all_probs_msg)
     
     def class_name_callback(self, msg):
-        classes = list(msg.classes)
+        classes = msg.classes
         self.classes=classes
         self.define_pub_register()
         print(f'Classes recieved: {classes}')
@@ -40,7 +40,7 @@ class MarkerPublisher:
         """
         groups = convert_dictionary_array_to_dict(msg.groups)
 
-        self.classes = [str(key) for key in groups.keys()]
+        self.classes = list(groups.keys())
 
 def publish_markers(markers: MarkerArray,topic: str = 'voxel_grid_array', publish_rate=1):
     """
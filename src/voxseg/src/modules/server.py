@@ -1,8 +1,8 @@
 import rospy
 #from costmap_2d.msg import VoxelGrid
 from geometry_msgs.msg import Point32, Vector3
-from voxseg.msg import DepthImageInfo, WorldInfo, Classes, VoxelGrid
-from voxseg.srv import VoxelComputation, VoxelComputationResponse
+from voxseg.msg import DepthImageInfo, CompressedDepthImageInfo, WorldInfo, Classes, VoxelGrid
+from voxseg.srv import VoxelComputation, VoxelComputationResponse, SparseVoxelComputation, SparseVoxelComputationResponse
 from std_msgs.msg import String
 from sensor_msgs.msg import Image
 from cv_bridge import CvBridge
@@ -10,13 +10,15 @@ from cv_bridge import CvBridge
 import numpy as np
 import json
 import torch
+import queue
+import threading
 
 from modules.data import BackendData, UnalignedData
 from modules.voxel_world import VoxelWorld
 
 #from modules.config import *
 from modules.real_data_cfg import *
-from modules.utils import convert_dictionary_array_to_dict
+from modules.utils import convert_dictionary_array_to_dict, voxel_classes_to_bytes, sparse_voxel_classes, extrinsics_from_msg, decode_compressed_depth_msg
 
 class VoxSegServer:
     def __init__(self):
@@ -30,7 +32,7 @@ class VoxSegServer:
         """
         self.cams_aligned = CAMS_ALIGNED
 
-        self.world = VoxelWorld(**WORLD_CONFIG, root_dir=VOXSEG_ROOT_DIR) 
+        self.world = VoxelWorld(**WORLD_CONFIG, root_dir=VOXSEG_ROOT_DIR, graph_batch_size=BATCH_SIZE) 
 
         if self.cams_aligned:
             self.data = BackendData(device='cuda', batch_size=BATCH_SIZE)
@@ -41,13 +43,30 @@ class VoxSegServer:
         self.img_count = 0
         self.batch_size = BATCH_SIZE
         self.recast_required = True
+        self.grid_msgs = None # cached origin and resolution msgs, see _get_grid_msgs
+
+        self.bridge = CvBridge()
+
+        # the rospy receive thread only enqueues frames, and the ingest worker decodes them and updates the world.
+        # maxsize=1 means that frames which arrive while the worker is busy replace the pending one
+        self._frame_q = queue.Queue(maxsize=1)
+        self._world_lock = threading.Lock() # guards self.world and self.data, which are shared with the service thread
+
+        # service handlers only enqueue requests, and the compute worker runs them one at a time (see _run_on_compute_worker)
+        self._request_q = queue.Queue()
         
         rospy.init_node(SERVER_NODE, anonymous=True)
-        rospy.Subscriber(IMAGE_TOPIC, DepthImageInfo, self._depth_image_callback)
+
+        threading.Thread(target=self._ingest_worker, daemon=True).start()
+        threading.Thread(target=self._compute_worker, daemon=True).start()
+
+        rospy.Subscriber(IMAGE_TOPIC, DepthImageInfo, self._depth_image_callback, queue_size=1, buff_size=2**24)
+        rospy.Subscriber(COMPRESSED_IMAGE_TOPIC, CompressedDepthImageInfo, self._depth_image_callback, queue_size=1, buff_size=2**24)
         rospy.Subscriber(CLASS_TOPIC, Classes, self._class_name_callback)
         rospy.Subscriber(WORLD_DIM_TOPIC, WorldInfo, self._world_dim_callback, buff_size=100000) # SET BUFFER SIZE
         rospy.Subscriber(RESET_TOPIC, String, self._reset_callback)
         rospy.Service(VOXEL_REQUEST_SERVICE, VoxelComputation, self._handle_compute_request)
+        rospy.Service(SPARSE_VOXEL_REQUEST_SERVICE, SparseVoxelComputation, self._handle_sparse_compute_request)
         self.voxel_pub = rospy.Publisher(VOXEL_TOPIC, VoxelGrid, queue_size=10)
     
         print('Backend Has Been Initialized')
@@ -65,38 +84,74 @@ class VoxSegServer:
         # tensors will be None if in batch mode and no tensors have 
         # been added since the last time get_tensors was called
         tensors = self.data.get_tensors(world=self.world)
+        self.img_count = 0
+
+        if tensors is None:
+            return # nothing new to project, so don't launch or wait on a world update
 
-        if tensors and self.cams_aligned:
+        if self.cams_aligned:
             image_tensor, depths, cam_locs = tensors
             self.world.batched_update_world(image_tensor, depths, cam_locs, K_RGB.float())
-        elif tensors and not self.cams_aligned:
+        else:
             image_tensor, depth_tensor, rgb_extr_tensor, depth_extr_tensor = tensors
             self.world.batched_update_world(image_tensor, depth_tensor, rgb_extr_tensor,K_RGB.float(), depth_extr_tensor , K_DEPTH.float())
         
-        self.img_count = 0
         torch.cuda.synchronize() # wait for all world updates before doing inference
 
     def _handle_compute_request(self, req):
-        # Update from the most recent tensors 
+        return self._run_on_compute_worker(self._compute_voxels, req)
 
-        if self.recast_required:
-            self._update_world()
-            self.recast_required = False
+    def _handle_sparse_compute_request(self, req):
+        return self._run_on_compute_worker(self._compute_sparse_voxels, req)
 
-        min_pts_in_voxel = req.min_pts_in_voxel
-        if self.data.use_prompts:
-            voxel_classes = self.world.get_classes_by_groups(self.data.prompts, self.data.groups, min_points_in_voxel=min_pts_in_voxel)
-        else:
-            voxel_classes = self.world.get_classes_by_groups(self.data.classes, self.data.groups, min_points_in_voxel=min_pts_in_voxel)
+    def _run_on_compute_worker(self, compute_fn, req):
+        """
+        Runs on a rospy service thread. Hands the request to the compute worker, and blocks until compute_fn(req) is ready
+        """
+        request = {'fn': compute_fn, 'req': req, 'done': threading.Event()}
+        self._request_q.put(request)
+        request['done'].wait()
+
+        if 'error' in request:
+            raise request['error'] # rospy reports this to the client as a ServiceException
+        return request['response']
+
+    def _compute_worker(self):
+        while True:
+            request = self._request_q.get()
+            try:
+                request['response'] = request['fn'](request['req'])
+            except Exception as e:
+                request['error'] = e
+            request['done'].set()
+
+    def _classify_voxels(self, req):
+        """
+        Returns:
+            the grouped voxel classes (see VoxelWorld.get_classes_by_groups), and the origin and resolution msgs of the world
+        """
+        with self._world_lock:
+            # Update from the most recent tensors 
+            if self.recast_required:
+                self._update_world()
+                self.recast_required = False
+
+            # only the snapshot needs the lock; new frames can be projected during inference
+            snapshot = self.world.snapshot_voxels(req.min_pts_in_voxel)
+            classes = self.data.prompts if self.data.use_prompts else self.data.classes
+            groups = self.data.groups
+            origin, vec_resolution = self._get_grid_msgs()
 
+        voxel_classes = self.world.get_classes_by_groups(classes, groups, snapshot=snapshot)
+
+        return voxel_classes, origin, vec_resolution
+
+    def _compute_voxels(self, req):
+        voxel_classes, origin, vec_resolution = self._classify_voxels(req)
         x,y,z = voxel_classes.size()
 
-        voxel_classes_unsigned = voxel_classes + 1 # need to convert them to bytes for ros, but -1 classes will cause issues with this
-        flattened_voxels = voxel_classes_unsigned.flatten().byte().tolist()
-        origin = Point32(self.world.voxel_origin[0], self.world.voxel_origin[1], self.world.voxel_origin[2])
-        
-        resolution = self.world.compute_resolution()
-        vec_resolution = Vector3(x=resolution[0], y=resolution[1],z=resolution[2])
+        # genpy serializes a uint8[] field directly from bytes, instead of packing a list element by element
+        flattened_voxels = voxel_classes_to_bytes(voxel_classes)
 
         voxel_response = VoxelComputationResponse(data=flattened_voxels, 
                   origin=origin,
@@ -116,60 +171,124 @@ class VoxSegServer:
                         )
         self.voxel_pub.publish(voxel_msg)
 
-        print('Computation Complete')
+        rospy.loginfo('Computation Complete')
         
         return voxel_response
 
-    def _world_dim_callback(self, msg):
-        print('Updating World Dim')
-        self.world.update_dims(msg.world_dim, msg.grid_dim)
-        self.data.reset_buffers()
-        self.data.fill_buffers()
-        self.recast_required = True
+    def _compute_sparse_voxels(self, req):
+        """
+        Only the labeled voxels are sent, as (flat index, class + 1) pairs. 
+        Nothing is published to the voxel topic, since that would send the dense grid anyway
+        """
+        voxel_classes, origin, vec_resolution = self._classify_voxels(req)
+        x,y,z = voxel_classes.size()
 
+        indices, labels = sparse_voxel_classes(voxel_classes)
 
+        voxel_response = SparseVoxelComputationResponse(indices=indices,
+                  labels=labels,
+                  origin=origin,
+                  resolutions=vec_resolution,
+                  size_x=x,
+                  size_y=y,
+                  size_z=z)
 
-    def _depth_image_callback(self, msg):
+        rospy.loginfo(f'Sparse Computation Complete ({len(indices)} labeled voxels)')
 
-        image_msg = msg.rgb_image
-        depths_msg = msg.depth_image
-        rgb_extrinsics_msg = msg.cam_extrinsics
-        rgb_extrinsics = np.array(rgb_extrinsics_msg).reshape(4,4)
+        return voxel_response
 
+    def _get_grid_msgs(self):
+        """
+        Returns:
+            Point32 voxel origin and Vector3 resolution of self.world. These only change with the world dims, 
+            so they are built once and reused across requests
+        """
+        if self.grid_msgs is None:
+            origin = Point32(*self.world.voxel_origin.tolist())
+            resolution = Vector3(*self.world.compute_resolution().tolist())
+            self.grid_msgs = (origin, resolution)
+        return self.grid_msgs
 
-        bridge = CvBridge()
-        img = bridge.imgmsg_to_cv2(image_msg, desired_encoding="passthrough")
-        np_image = np.array(img)
-        # convert to BGR
-        np_image = np_image[:, :, ::-1]
+    def _world_dim_callback(self, msg):
+        rospy.loginfo('Updating World Dim')
+        with self._world_lock:
+            self.world.update_dims(msg.world_dim, msg.grid_dim)
+            self.grid_msgs = None
+            self.data.reset_buffers()
+            self.data.fill_buffers()
+            self.recast_required = True
 
-        depths = bridge.imgmsg_to_cv2(depths_msg, desired_encoding="passthrough")
-        np_depths = np.array(depths)
 
-        if self.cams_aligned:
-            self.data.add_depth_image(np_image, np_depths, rgb_extrinsics)
-        else:
-            depth_extrinsics_msg = msg.depth_extrinsics
-            depth_extrinsics = np.array(depth_extrinsics_msg).reshape(4,4)
-            self.data.add_depth_image(np_image, np_depths, rgb_extrinsics, depth_extrinsics)
 
-        print(f'Depth Image {len(self.data.all_images)} Received')
+    def _depth_image_callback(self, msg):
+        """
+        Runs on the rospy receive thread, so only hands the message off to the ingest worker.
+        If the worker has not picked up the previous frame yet, that frame is dropped
+        """
+        # loop, because the raw and compressed image subscribers can both be putting frames
+        while True:
+            try:
+                self._frame_q.put_nowait(msg)
+                return
+            except queue.Full:
+                try:
+                    self._frame_q.get_nowait()
+                except queue.Empty:
+                    pass # the worker took the stale frame in the meantime
+
+    def _ingest_worker(self):
+        while True:
+            msg = self._frame_q.get()
+            try:
+                self._add_depth_image(msg)
+            except Exception as e:
+                # like a rospy callback, log and move on to the next frame instead of ending the worker
+                rospy.logerr(f'Error while adding depth image: {e}')
+
+    def _add_depth_image(self, msg):
+        """
+        Decodes a DepthImageInfo or CompressedDepthImageInfo msg, adds it to self.data, and updates the world once a batch has accumulated
+        """
+        image_msg = msg.rgb_image
+        depths_msg = msg.depth_image
+        rgb_extrinsics = extrinsics_from_msg(msg.cam_extrinsics)
 
-        self.recast_required = True
-        # Update the world as images come in, if batch size is defined
-        if self.batch_size:
-            self.img_count += 1
-            if self.img_count == self.batch_size:
-                self._update_world()
-                self.recast_required = False        
+        # cv_bridge does the RGB -> BGR conversion, and already returns an ndarray
+        if isinstance(msg, CompressedDepthImageInfo):
+            np_image = self.bridge.compressed_imgmsg_to_cv2(image_msg, desired_encoding="bgr8")
+            np_depths = decode_compressed_depth_msg(depths_msg)
+        else:
+            np_image = self.bridge.imgmsg_to_cv2(image_msg, desired_encoding="bgr8")
+            np_depths = self.bridge.imgmsg_to_cv2(depths_msg, desired_encoding="passthrough")
+
+        if not self.cams_aligned:
+            depth_extrinsics = extrinsics_from_msg(msg.depth_extrinsics)
+
+        with self._world_lock:
+            if self.cams_aligned:
+                self.data.add_depth_image(np_image, np_depths, rgb_extrinsics)
+            else:
+                self.data.add_depth_image(np_image, np_depths, rgb_extrinsics, depth_extrinsics)
+
+            rospy.logdebug_throttle(1.0, f'Depth Image {len(self.data.all_images)} Received') # per frame, so keep it off stdout
+
+            self.recast_required = True
+            # Update the world as images come in, if batch size is defined
+            if self.batch_size:
+                self.img_count += 1
+                if self.img_count == self.batch_size:
+                    self._update_world()
+                    self.recast_required = False        
                 
 
     def _reset_callback(self, msg):
-        self.world.reset_world()
-        self.data.reset_all()
-        self.recast_required = True
-        self.img_count = 0
-        print('World has been reset')
+        with self._world_lock:
+            self.world.reset_world()
+            self.data.reset_all()
+            self.recast_required = True
+            self.grid_msgs = None
+            self.img_count = 0
+        rospy.loginfo('World has been reset')
 
 
     def unserialize_string(self, ser):
@@ -184,8 +303,9 @@ class VoxSegServer:
         groups = convert_dictionary_array_to_dict(msg.groups)
 
 
-        classes = list(msg.classes)
+        classes = msg.classes # genpy already deserializes string[] as a list of str
         use_prompts = bool(msg.use_prompts)
-        self.data.add_class_info(classes, prompts, groups, use_prompts)
+        with self._world_lock:
+            self.data.add_class_info(classes, prompts, groups, use_prompts)
 
-        print(f'Classes recieved: {classes}')
+        rospy.loginfo(f'Classes recieved: {classes}')
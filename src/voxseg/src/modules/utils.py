@@ -7,6 +7,7 @@ from detectron2.data.detection_utils import read_image
 from visualization_msgs.msg import Marker, MarkerArray
 from std_msgs.msg import ColorRGBA
 from sensor_msgs.msg import Image as RosImage
+from sensor_msgs.msg import CompressedImage
 from geometry_msgs.msg import Vector3, Point, Quaternion, Pose
 from cv_bridge import CvBridge
 from voxseg.srv import VoxelComputationResponse
@@ -204,7 +205,23 @@ def get_all_pixels(numrows, numcols, device='cuda'):
     homo_pixels = torch.concat((oned_pixels,ones),1).to(device)
     return homo_pixels
 
-def align_depth_to_rgb(rgb, K_rgb, T_rgb, d, K_d, T_d):
+def get_camera_rays(intrinsics, pixels):
+    """
+    Inputs:
+        intrinsics: (4,4)
+
+        pixels: (N, 4), homogenous pixel coordinates (see get_all_pixels)
+    Returns:
+        (N, 4), the ray through each pixel in camera coordinates, normalized so that its first 3 coordinates have unit norm
+    """
+    Kinv = torch.inverse(intrinsics)
+    # get pixel coordinates in the camera plane
+    cam_pts = (Kinv @ pixels.T).T
+    # normalize camera coordinates (plane -> sphere)
+    cam_pts_norm = cam_pts / (torch.norm(cam_pts[:, :3], dim=1)[None].T)
+    return cam_pts_norm
+
+def align_depth_to_rgb(rgb, K_rgb, T_rgb, d, K_d, T_d, rays_d=None):
     """
     NOTE: currently does not support batching, because this would result in jagged arrays
     Inputs:
@@ -214,14 +231,16 @@ def align_depth_to_rgb(rgb, K_rgb, T_rgb, d, K_d, T_d):
         d: torch.Tensor, (1, h, w)
         K_d: (4, 4), depth camera intrinsics
         T_d: (4, 4), depth camera extrinsics
+        rays_d: (h*w, 4), optional precomputed get_camera_rays for the depth camera
     Returns:
         Two tensors, shape (M, 3) and (M, 2). The first tensor contains world coords of the depths,
         and the second contains the pixel coordinates in rgb image space for those depths.
     """
     _, h_d, w_d = d.size()
     _, h_rgb, w_rgb = rgb.size()
-    pixels_d = get_all_pixels(h_d, w_d)
-    d_in_wld = unproject(K_d, T_d[None], pixels_d, d, return_homogenous=True)
+    if rays_d is None:
+        rays_d = get_camera_rays(K_d, get_all_pixels(h_d, w_d))
+    d_in_wld = unproject(K_d, T_d[None], None, d, return_homogenous=True, rays=rays_d)
 
     d_in_rgb = project(K_rgb, T_rgb[None], d_in_wld).squeeze(0)
     boundary_mask = (d_in_rgb[:,0] < h_rgb) & (d_in_rgb[:,0] > 0) & (d_in_rgb[:,1] < w_rgb) & (d_in_rgb[:,1] > 0)
@@ -261,7 +280,7 @@ def project(intrinsics, extrinsics, points):
 
     return px
 
-def unproject(intrinsics, extrinsics, pixels, depth, return_homogenous=False):
+def unproject(intrinsics, extrinsics, pixels, depth, return_homogenous=False, rays=None):
     """
     Inputs:
         intrinsics: (4,4)
@@ -271,21 +290,21 @@ def unproject(intrinsics, extrinsics, pixels, depth, return_homogenous=False):
         pixels: (N, 4)
 
         depth: (B, h, w)
+
+        rays: (N, 4), optional precomputed get_camera_rays(intrinsics, pixels). If given, intrinsics and pixels are unused
     Returns:
         (B, 4, h*w ) if return_homogenous else (B, 3, h, w)
     
     """
-    Kinv = torch.inverse(intrinsics)
-    # get pixel coordinates in the camera plane
-    cam_pts = (Kinv @ pixels.T).T
-    # normalize camera coordinates (plane -> sphere)
-    cam_pts_norm = cam_pts / (torch.norm(cam_pts[:, :3], dim=1)[None].T)
+    if rays is None:
+        rays = get_camera_rays(intrinsics, pixels)
+    cam_pts_norm = rays
 
     batches, height, width = depth.size()
     if not return_homogenous:
-        all_wld_pts = torch.zeros((batches, 3, height, width)).cuda()
+        all_wld_pts = torch.zeros((batches, 3, height, width), device=depth.device)
     else:
-        all_wld_pts = torch.zeros((batches, 4, height*width)).cuda()
+        all_wld_pts = torch.zeros((batches, 4, height*width), device=depth.device)
 
     # for each image
     for i in range(len(extrinsics)):
@@ -352,6 +371,16 @@ def get_cam_msg(extrinsics):
     """
     return np.reshape(extrinsics, (16,)).tolist()
 
+def extrinsics_from_msg(cam_msg):
+    """
+    Inverse of get_cam_msg
+    cam_msg: a float64[16] msg field, which rospy deserializes as a tuple of floats
+    Returns:
+        np array of camera extrinsics, size (4,4), float32
+    """
+    # fromiter with a known count fills a single float32 buffer, rather than inferring a float64 array and casting it later
+    return np.fromiter(cam_msg, dtype=np.float32, count=16).reshape(4,4)
+
 def get_image_msg(image, timestamp=None) -> RosImage:
     """
     Inputs:
@@ -386,11 +415,76 @@ def get_depth_msg(depth_map, timestamp) -> Image:
 
     return depth_msg
 
+def get_compressed_image_msg(image, timestamp=None) -> CompressedImage:
+    """
+    Inputs:
+        image: a numpy array containing rgb image data, shape (h,w,c), uint8
+    """
+    img_msg = CompressedImage()
+    img_msg.format = "rgb8; jpeg compressed bgr8"
+    img_msg.data = cv2.imencode('.jpg', cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
+    if timestamp:
+        img_msg.header.stamp = timestamp
+    img_msg.header.frame_id = 'img_frame'
+
+    return img_msg
+
+def get_compressed_depth_msg(depth_map, timestamp) -> CompressedImage:
+    """
+    depth_map: a numpy array containing depth data in meters, size (h,w)
+
+    The depths are stored as 16 bit millimeters in a png (like 16UC1 depth images, see REP 118), so they are clipped to 65.535 m.
+    Invalid (nan or non-positive) depths are stored as 0, which decode_compressed_depth_msg turns back into nan
+    """
+    depth_mm = np.clip(np.round(np.nan_to_num(depth_map) * 1000), 0, 65535).astype(np.uint16)
+    depth_msg = CompressedImage()
+    depth_msg.format = '16UC1; png compressed'
+    depth_msg.data = cv2.imencode('.png', depth_mm)[1].tobytes()
+    depth_msg.header.stamp = timestamp
+    depth_msg.header.frame_id = 'depth_frame'
+
+    return depth_msg
+
+def decode_compressed_depth_msg(depth_msg):
+    """
+    Inputs:
+        depth_msg: a png compressed sensor_msgs/CompressedImage, from get_compressed_depth_msg 
+        or from the compressed_depth_image_transport plugin ("compressedDepth" format)
+    Returns:
+        np array containing depth data in meters, size (h,w), float32. Invalid depths are nan
+    """
+    encoding = depth_msg.format.split(';')[0].strip()
+    compressed_depth = 'compressedDepth' in depth_msg.format
+
+    # only png is decoded here, and 32FC1 depths can only be decoded with the plugin's quantization header
+    if encoding not in ('16UC1', '32FC1') or (encoding == '32FC1' and not compressed_depth) or 'rvl' in depth_msg.format:
+        raise ValueError(f'Unsupported compressed depth format: {depth_msg.format}')
+
+    buf = np.frombuffer(depth_msg.data, dtype=np.uint8)
+
+    if compressed_depth:
+        # the plugin prefixes the png with a 12 byte header: int32 format, float32 depthQuantA, float32 depthQuantB
+        quant_a, quant_b = np.frombuffer(depth_msg.data, dtype=np.float32, count=2, offset=4)
+        buf = buf[12:]
+
+    raw = cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    if raw is None:
+        raise ValueError(f'Could not decode compressed depth image with format: {depth_msg.format}')
+
+    if encoding == '32FC1':
+        # the plugin quantizes 32FC1 depths as inverse depths, and 0 means the depth was invalid
+        inv_depth = raw.astype(np.float32)
+        with np.errstate(divide='ignore'):
+            return np.where(inv_depth > 0, quant_a / (inv_depth - quant_b), np.nan).astype(np.float32)
+
+    # 16UC1 depths are in millimeters, and 0 means the depth was invalid (REP 118)
+    return np.where(raw > 0, raw.astype(np.float32) / 1000, np.nan).astype(np.float32)
+
 def decode_compressed_image_msg(image_msg, bridge):
 
-    img = bridge.compressed_imgmsg_to_cv2(image_msg, desired_encoding="passthrough")
-    np_image = np.array(img)
-    np_image = np_image[:, :, ::-1] # convert to BGR
+    # the image is decoded as BGR, and cv_bridge swaps the channels in one cvtColor pass instead of a strided flip
+    # cv_bridge already returns an ndarray, and torch_from_img_array_msg's np.stack makes the only copy that is needed
+    np_image = bridge.compressed_imgmsg_to_cv2(image_msg, desired_encoding="rgb8")
     np_image = np.moveaxis(np_image, -1, 0) # convert to 3,H,W
     return np_image
 
@@ -437,6 +531,39 @@ def convert_dictionary_array_to_dict(dictionary_jsons):
 
     return result_dict
 
+def voxel_classes_to_bytes(voxel_classes):
+    """
+    Inputs:
+        voxel_classes: torch.tensor, with class labels in [-1, 126] (-1 means no label)
+    Returns:
+        bytes containing voxel_classes + 1 as one uint8 per voxel, flattened in row major order (see voxels_from_srv)
+    """
+    if voxel_classes.numel() > 0:
+        low, high = torch.aminmax(voxel_classes)
+        if low.item() < -1 or high.item() > 126:
+            raise ValueError(f'Voxel classes must be in [-1, 126] to be sent as uint8, got [{low.item()}, {high.item()}]')
+
+    # -1 as an int8 has the same bits as 255 as a uint8, so adding 1 in place wraps it to 0.
+    # The only allocation is the 1 byte per voxel output, on the same device as voxel_classes
+    flat = voxel_classes.reshape(-1).to(torch.int8, copy=True).view(torch.uint8).add_(1)
+    return flat.cpu().numpy().tobytes()
+
+def sparse_voxel_classes(voxel_classes):
+    """
+    Inputs:
+        voxel_classes: torch.tensor, with class labels in [-1, 126] (-1 means no label)
+    Returns:
+        indices: list of the row major flat indices of the labeled voxels
+        
+        labels: bytes containing voxel_classes + 1 for each of those voxels (see voxel_classes_to_bytes)
+    """
+    flat = voxel_classes.reshape(-1)
+    indices = torch.nonzero(flat >= 0).squeeze(1)
+    labels = voxel_classes_to_bytes(flat[indices])
+
+    # genpy packs uint32[] element by element, so this stays a list, but only labeled voxels are in it
+    return indices.cpu().tolist(), labels
+
 def voxels_from_srv(msg):
     """
     Given a VoxelComputationRespons msg, extract the voxel structure containing classes
@@ -444,7 +571,7 @@ def voxels_from_srv(msg):
         voxels: torch.tensor, shape grid_dim, with values representing classes. NOTE: the first specified class is 0, and the empty class is -1.
         world_dim: torch.tensor, shape(3,), represents the xyz dimensions of the world
     """
-    voxels: torch.Tensor = torch.as_tensor(msg.data).float()
+    voxels: torch.Tensor = torch.from_numpy(np.frombuffer(msg.data, dtype=np.uint8).astype(np.float32)) # rospy returns uint8[] as bytes
     voxels -= 1 # the backend adds 1 to the voxel classes, in order to encode the array in bytes
     voxel_grid_shape = (msg.size_x, msg.size_y, msg.size_z)
     voxels = voxels.view(*voxel_grid_shape)
@@ -454,6 +581,25 @@ def voxels_from_srv(msg):
     world_dim = grid_dim / resolutions
     return voxels, world_dim
 
+def voxels_from_sparse_srv(msg):
+    """
+    Given a SparseVoxelComputationResponse msg, rebuild the dense voxel structure containing classes
+    Returns:
+        voxels, world_dim: see voxels_from_srv
+    """
+    voxel_grid_shape = (msg.size_x, msg.size_y, msg.size_z)
+    voxels = torch.full((msg.size_x * msg.size_y * msg.size_z,), -1.0) # unlisted voxels have no label
+
+    indices = torch.as_tensor(msg.indices, dtype=torch.long)
+    labels = torch.from_numpy(np.frombuffer(msg.labels, dtype=np.uint8).astype(np.float32))
+    voxels[indices] = labels - 1 # the backend adds 1 to the voxel classes, in order to encode the array in bytes
+    voxels = voxels.view(*voxel_grid_shape)
+
+    resolutions = torch.as_tensor([msg.resolutions.x, msg.resolutions.y, msg.resolutions.z])
+    grid_dim = torch.as_tensor(voxel_grid_shape)
+    world_dim = grid_dim / resolutions
+    return voxels, world_dim
+
 
 ################ Data Saving ##################
 
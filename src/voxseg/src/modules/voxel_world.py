@@ -11,7 +11,7 @@ from modules.ovseg.open_vocab_seg.ws_ovseg_model import WSTextFeatureModel, WSIm
 WINDOW_NAME = "OVSeg"
 
 class VoxelWorld:
-    def __init__(self, world_dim, grid_dim, embed_size, voxel_origin=(0,0,0), device='cuda', root_dir=None):
+    def __init__(self, world_dim, grid_dim, embed_size, voxel_origin=(0,0,0), device='cuda', root_dir=None, graph_batch_size=None):
         """
         world_dim: tuple (3,), dimension of world (probably in m)
 
@@ -22,8 +22,13 @@ class VoxelWorld:
         embed_size: int, dimension of the feature embeddings
 
         root_dir: the directory from which python is being called (PYTHON_PATH). None if running from current directory
+
+        graph_batch_size: the steady-state number of images per update. Full chunks of that many images (at most the 
+        max_batch_size of batched_update_world) are projected with CUDA graphs (see project_to_voxels). None to always project eagerly.
+        Only aligned cameras use project_to_voxels, so unaligned updates are always eager
         """
         self.device = device
+        self.graph_batch_size = graph_batch_size
         t0 = time.time()
         self.predictor = WSImageEncoder(root_dir = root_dir)
         t1 = time.time()
@@ -47,7 +52,28 @@ class VoxelWorld:
 
         self.voxels = torch.zeros((gx+2,gy+2,gz+2,embed_size),device=device)
         self.grid_count = torch.zeros((gx+2,gy+2,gz+2),device=self.device) # for the running average
+
+        # (height, width, intrinsics) -> camera rays, since they are the same for every frame from a camera
+        self.ray_cache = {}
+
+        # (depth size, intrinsics) -> captured CUDA graph of the projection, see project_to_voxels
+        self.projection_graphs = {}
     
+    def get_camera_rays(self, intrinsics, height, width):
+        """
+        Inputs:
+            intrinsics: torch.tensor, (4,4)
+
+            height, width: image size
+        Returns:
+            torch.tensor on self.device, (height*width, 4), the cached get_camera_rays for each pixel of the image
+        """
+        key = (height, width, tuple(intrinsics.flatten().tolist()))
+        if key not in self.ray_cache:
+            pixels = get_all_pixels(height, width, device=self.device)
+            self.ray_cache[key] = get_camera_rays(intrinsics.to(self.device), pixels)
+        return self.ray_cache[key]
+
     def update_dims(self, world_dim, grid_dim):
         """
         world_dim: array_like, shape (3,)
@@ -61,6 +87,8 @@ class VoxelWorld:
         self.voxels = torch.zeros((gx+2,gy+2,gz+2,self.embed_size),device=self.device)
         self.grid_count = torch.zeros((gx+2,gy+2,gz+2),device=self.device) # for the running average
 
+        self.projection_graphs = {} # the graphs captured the old world_dim and grid_dim tensors
+
         print(f'New grid dim: {self.voxels.size()}')
 
     def compute_resolution(self) -> torch.Tensor:
@@ -73,6 +101,7 @@ class VoxelWorld:
     def reset_world(self):
         self.voxels = torch.zeros_like(self.voxels)
         self.grid_count = torch.zeros_like(self.grid_count)
+        self.projection_graphs = {}
     
     def _aligned_update_world(self, rgb, T_rgb ,K_rgb, d,T_d, K_d):
         """
@@ -91,6 +120,8 @@ class VoxelWorld:
         """
 
         B, _, h, w= rgb.size()
+        _, _, h_d, w_d = d.size()
+        rays_d = self.get_camera_rays(K_d, h_d, w_d)
         
         t1 = time.time()
 
@@ -113,7 +144,7 @@ class VoxelWorld:
             T_rgb_i = T_rgb[i]
             T_d_i = T_d[i]
 
-            valid_world_locs, valid_rgb_pixels = align_depth_to_rgb(rgb_i, K_rgb, T_rgb_i, d_i, K_d, T_d_i)
+            valid_world_locs, valid_rgb_pixels = align_depth_to_rgb(rgb_i, K_rgb, T_rgb_i, d_i, K_d, T_d_i, rays_d=rays_d)
         
             # Necessary to convert to a bool mask to avoid overflowing vram
             valid_pixel_mask = torch.zeros((h,w), dtype=bool)
@@ -127,15 +158,14 @@ class VoxelWorld:
         print(f'Projection and World Update Time: {t3 - t2}')
 
 
-    def _update_world(self, images, depths, cam_extrinsics, cam_intrinsics):
+    def _update_world(self, images, depths, cam_extrinsics, cam_intrinsics, use_graph=False):
         """
         Behavior:
             Run the model on image, and update the corresponding voxels
         """
         
         t1 = time.time()
-        world_locs = self.image_to_world(depths.to(self.device), cam_extrinsics.to(self.device), cam_intrinsics.to(self.device))
-        voxel_locs = self.world_to_voxel(world_locs)
+        voxel_locs = self.project_to_voxels(depths.to(self.device), cam_extrinsics.to(self.device), cam_intrinsics, use_graph=use_graph)
         t2 = time.time()
         print(f'Pixel projection time: {t2 - t1}')
 
@@ -170,6 +200,9 @@ class VoxelWorld:
             Otherwise, this will attempt to align the cameras before projecting into the world
             """
 
+            # only the steady-state chunk size is projected with a CUDA graph, see project_to_voxels
+            graph_chunk_size = min(self.graph_batch_size, max_batch_size) if self.graph_batch_size else None
+
             splits = list(range(0, len(all_images), max_batch_size))
             splits.append(len(all_images)) # ensure the leftovers are still included
             for i in range(len(splits) - 1): 
@@ -187,10 +220,62 @@ class VoxelWorld:
                 elif depth_intrinsics is not None or all_depth_extrinsics is not None:
                     raise ValueError("Invalid combination of arguments.")
                 else:
-                    self._update_world(images, depths, rgb_extrinsics, rgb_intrinsics)
+                    self._update_world(images, depths, rgb_extrinsics, rgb_intrinsics, use_graph=(end - start == graph_chunk_size))
                 
             
 
+    def project_to_voxels(self, depths, cam_extrinsics, cam_intrinsics, use_graph=False):
+        """
+        Inputs:
+            depths, cam_extrinsics, cam_intrinsics: see image_to_world 
+
+            use_graph: whether to project with a CUDA graph (only on cuda)
+
+        Returns:
+            torch.tensor, shape (batch, height, width, 3): the voxel indices of each pixel (see world_to_voxel)
+
+        With use_graph, the projection is captured in a CUDA graph the first time each input shape is seen, and replayed after that.
+        batched_update_world only sets it for the steady-state chunk size, since each capture is expensive and keeps its own memory pool,
+        so one-off sizes (e.g. the leftover frames of a compute request) are projected eagerly.
+        NOTE: when a graph is replayed, the returned tensor is the graph's static output, so it is overwritten by the next call
+        """
+        if not use_graph or torch.device(self.device).type != 'cuda':
+            return self.world_to_voxel(self.image_to_world(depths, cam_extrinsics, cam_intrinsics))
+
+        key = (tuple(depths.size()), tuple(cam_intrinsics.flatten().tolist()))
+        if key not in self.projection_graphs:
+            self.projection_graphs[key] = self._capture_projection(depths, cam_extrinsics, cam_intrinsics)
+
+        graph, static_depths, static_extrinsics, static_voxel_locs = self.projection_graphs[key]
+        static_depths.copy_(depths)
+        static_extrinsics.copy_(cam_extrinsics)
+        graph.replay()
+
+        return static_voxel_locs
+
+    def _capture_projection(self, depths, cam_extrinsics, cam_intrinsics):
+        """
+        Returns:
+            (graph, static depths input, static extrinsics input, static voxel locs output) for project_to_voxels
+        """
+        static_depths = depths.clone()
+        static_extrinsics = cam_extrinsics.clone()
+
+        # warm up on a side stream before capturing (this also fills self.ray_cache, which can't be done during capture)
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            self.world_to_voxel(self.image_to_world(static_depths, static_extrinsics, cam_intrinsics))
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        # the compute worker runs inference on other streams while this thread captures. thread_local mode only rejects
+        # unsafe calls (allocations, syncs) made from this thread, so that work doesn't invalidate the capture
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+            static_voxel_locs = self.world_to_voxel(self.image_to_world(static_depths, static_extrinsics, cam_intrinsics))
+
+        return graph, static_depths, static_extrinsics, static_voxel_locs
+
     def world_to_voxel(self, world_locs : torch.Tensor,):
         """
         Input:
@@ -236,73 +321,99 @@ class VoxelWorld:
         """
         _, _, height, width = depth.size()
 
-        pixels = get_all_pixels(height, width)
+        rays = self.get_camera_rays(cam_intrinsics, height, width)
 
-        px_w = unproject(cam_intrinsics, cam_extrinsics, pixels, depth.squeeze(1))
+        px_w = unproject(cam_intrinsics, cam_extrinsics, None, depth.squeeze(1), rays=rays)
         return px_w.nan_to_num().permute(0,2,3,1)
     
-    def get_voxel_classes(self, classes: Union[List[str], Dict[str, List[str]]], min_points_in_voxel=0):
+    def snapshot_voxels(self, min_points_in_voxel=0):
+        """
+        Copies out the features of the non-empty voxels, so they can be classified while the world keeps updating
+
+        Returns:
+            a snapshot (voxels_for_inference, non_empty_voxel_mask, grid size) to pass to get_voxel_classes or get_classes_by_groups
+        """
+        x,y,z,_ = self.voxels.size()
+
+        flat_voxels = self.voxels.flatten(end_dim = -2)
+        non_empty_voxel_mask = self.grid_count.flatten().cuda() > min_points_in_voxel # considered empty if no point was found in the voxel
+
+        # boolean indexing copies, so later updates to self.voxels don't affect the snapshot
+        voxels_for_inference = flat_voxels.cuda()[non_empty_voxel_mask]
+
+        return voxels_for_inference, non_empty_voxel_mask, (x,y,z)
+
+    def get_voxel_classes(self, classes: Union[List[str], Dict[str, List[str]]], min_points_in_voxel=0, snapshot=None):
         """
         Inputs:
             classes: list of class names, or dictionary of {class name: [prompts for class]}
+
+            snapshot: the result of snapshot_voxels. If None, the current voxels are used
         
         Returns:
-            tensor with shape (*self.grid_dim), with each element representing the class label of that voxel
+            int8 tensor with shape (*self.grid_dim), with each element representing the class label of that voxel (-1 means no label)
         """
         t1 = time.time()
-        x,y,z,_ = self.voxels.size()
-        
-        flat_voxels = self.voxels.flatten(end_dim = -2)
-        non_empty_voxel_mask = self.grid_count.flatten() > min_points_in_voxel # considered empty if no point was found in the voxel
+        # labels are stored as int8 (1 byte per voxel), so at most 127 classes are supported
+        if len(classes) > 127:
+            raise ValueError(f'At most 127 classes are supported, got {len(classes)}')
 
-        voxels_for_inference = flat_voxels.cuda()[non_empty_voxel_mask.cuda()]
+        if snapshot is None:
+            snapshot = self.snapshot_voxels(min_points_in_voxel)
+        voxels_for_inference, non_empty_voxel_mask, (x,y,z) = snapshot
 
         if type(classes) == dict:
-            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=True).float()
+            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=True)
         else:
-            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=False).float()
+            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=False)
 
-        all_voxel_classes = torch.ones(x*y*z).cuda() * -1 # -1 means no label
-        all_voxel_classes[non_empty_voxel_mask] = labeled_voxel_classes
+        all_voxel_classes = torch.full((x*y*z,), -1, dtype=torch.int8, device='cuda') # -1 means no label
+        all_voxel_classes[non_empty_voxel_mask] = labeled_voxel_classes.to(torch.int8)
 
         all_voxel_classes_reshaped = all_voxel_classes.view(x,y,z)
         print(f'Clip inference and similarity calculation time: {time.time()- t1}')
 
         return all_voxel_classes_reshaped
 
-    def get_classes_by_groups(self, classes, groups, min_points_in_voxel):
+    def get_classes_by_groups(self, classes, groups, min_points_in_voxel=0, snapshot=None):
         """
         classes: [class1, class2, ...]
         groups: {group1: [class1, class3], group2: [class2], ...}
-        Requires: a class is in a group iff it is in classes
+        snapshot: the result of snapshot_voxels. If None, the current voxels are used
+        Requires: a class is in a group iff it is in classes, and there are at most 127 classes
+
+        Returns:
+            int8 tensor with shape (*self.grid_dim), with each element representing the group index of that voxel (-1 means no label)
         """
         t1 = time.time()
-        x,y,z,_ = self.voxels.size()
-        
-        flat_voxels = self.voxels.flatten(end_dim = -2)
-        non_empty_voxel_mask = self.grid_count.flatten() > min_points_in_voxel # considered empty if no point was found in the voxel
+        # labels are stored as int8 (1 byte per voxel), so at most 127 classes are supported
+        if len(classes) > 127:
+            raise ValueError(f'At most 127 classes are supported, got {len(classes)}')
 
-        voxels_for_inference = flat_voxels.cuda()[non_empty_voxel_mask.cuda()]
+        if snapshot is None:
+            snapshot = self.snapshot_voxels(min_points_in_voxel)
+        voxels_for_inference, non_empty_voxel_mask, (x,y,z) = snapshot
 
         if type(classes) == dict:
-            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=True).float()
+            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=True)
             class_list = list(classes.keys())
         else:
-            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=False).float()
+            labeled_voxel_classes = self.text_model.get_nearest_classes(voxels_for_inference, classes,manual_prompts=False)
             class_list = classes
 
-        all_voxel_classes = torch.ones(x*y*z).cuda() * -1 # -1 means no label
-        all_voxel_classes[non_empty_voxel_mask] = labeled_voxel_classes
-
+        all_voxel_classes = torch.full((x*y*z,), -1, dtype=torch.int8, device='cuda') # -1 means no label
+        all_voxel_classes[non_empty_voxel_mask] = labeled_voxel_classes.to(torch.int8)
 
-        class_to_group = {}
+        # lookup table from class to group, offset by one so that -1 (no label) maps to itself.
+        # classes that are not in any group keep their class index
+        class_to_group = torch.arange(-1, len(class_list), dtype=torch.int8)
         keys = list(groups.keys())
         for i in range(len(keys)):
             group_key = keys[i]
             for cls in groups[group_key]:
-                class_to_group[class_list.index(cls)] = i
+                class_to_group[class_list.index(cls) + 1] = i
 
-        all_voxel_groups = torch.as_tensor([class_to_group.get(i.item(), i.item()) for i in all_voxel_classes])
+        all_voxel_groups = class_to_group.cuda()[all_voxel_classes.long() + 1]
 
         all_voxel_groups_reshaped = all_voxel_groups.view(x,y,z)
         print(f'Clip inference and similarity calculation time: {time.time()- t1}')
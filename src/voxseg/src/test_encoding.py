@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import struct
+import unittest
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import rospy
+import torch
+
+from modules.utils import voxel_classes_to_bytes, sparse_voxel_classes, voxels_from_srv, voxels_from_sparse_srv, get_compressed_depth_msg, decode_compressed_depth_msg
+
+
+def voxel_msg(size, **fields):
+    """
+    Stands in for a VoxelComputationResponse or SparseVoxelComputationResponse, with only the fields the decoders read
+    """
+    x, y, z = size
+    return SimpleNamespace(size_x=x, size_y=y, size_z=z, resolutions=SimpleNamespace(x=2.0, y=2.0, z=2.0), **fields)
+
+
+class TestVoxelEncoding(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.voxel_classes = torch.randint(-1, 5, (6, 5, 4), dtype=torch.int8)
+
+    def test_dense_round_trip(self):
+        msg = voxel_msg(self.voxel_classes.size(), data=voxel_classes_to_bytes(self.voxel_classes))
+        voxels, world_dim = voxels_from_srv(msg)
+
+        self.assertTrue(torch.equal(voxels, self.voxel_classes.float()))
+        self.assertTrue(torch.equal(world_dim, torch.as_tensor([3.0, 2.5, 2.0])))
+
+    def test_dense_rejects_out_of_range_classes(self):
+        with self.assertRaises(ValueError):
+            voxel_classes_to_bytes(torch.as_tensor([0, 127]))
+        with self.assertRaises(ValueError):
+            voxel_classes_to_bytes(torch.as_tensor([-2, 0]))
+
+    def test_sparse_round_trip(self):
+        indices, labels = sparse_voxel_classes(self.voxel_classes)
+        self.assertEqual(len(indices), int((self.voxel_classes >= 0).sum()))
+
+        msg = voxel_msg(self.voxel_classes.size(), indices=indices, labels=labels)
+        voxels, world_dim = voxels_from_sparse_srv(msg)
+
+        self.assertTrue(torch.equal(voxels, self.voxel_classes.float()))
+        self.assertTrue(torch.equal(world_dim, torch.as_tensor([3.0, 2.5, 2.0])))
+
+    def test_sparse_round_trip_empty(self):
+        empty = torch.full((3, 3, 3), -1, dtype=torch.int8)
+        indices, labels = sparse_voxel_classes(empty)
+
+        voxels, _ = voxels_from_sparse_srv(voxel_msg(empty.size(), indices=indices, labels=labels))
+        self.assertTrue(torch.equal(voxels, empty.float()))
+
+
+class TestDepthEncoding(unittest.TestCase):
+    def setUp(self):
+        self.depth = np.random.default_rng(0).uniform(0.5, 10, (48, 64)).astype(np.float32)
+
+    def test_16uc1_round_trip(self):
+        msg = get_compressed_depth_msg(self.depth, rospy.Time(0))
+        decoded = decode_compressed_depth_msg(msg)
+
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_allclose(decoded, self.depth, atol=5e-4) # stored as whole millimeters
+
+    def test_16uc1_invalid_depths(self):
+        self.depth[0, 0] = np.nan
+        self.depth[0, 1] = 0
+        self.depth[0, 2] = -1
+
+        decoded = decode_compressed_depth_msg(get_compressed_depth_msg(self.depth, rospy.Time(0)))
+
+        self.assertTrue(np.isnan(decoded[0, :3]).all())
+        np.testing.assert_allclose(decoded[1:], self.depth[1:], atol=5e-4)
+
+    def test_compressed_depth_32fc1(self):
+        # quantize like the compressedDepth plugin: inverse depth A / d + B in a 16 bit png, with 0 for invalid depths
+        quant_a, quant_b = 1000.0, -10.0
+        inv_depth = np.round(quant_a / self.depth + quant_b).astype(np.uint16)
+        inv_depth[0, 0] = 0
+        header = struct.pack('<iff', 0, quant_a, quant_b)
+        msg = SimpleNamespace(format='32FC1; compressedDepth png', data=header + cv2.imencode('.png', inv_depth)[1].tobytes())
+
+        decoded = decode_compressed_depth_msg(msg)
+
+        expected = quant_a / (inv_depth.astype(np.float32) - quant_b)
+        self.assertTrue(np.isnan(decoded[0, 0]))
+        np.testing.assert_allclose(decoded.flatten()[1:], expected.flatten()[1:], rtol=1e-6)
+        np.testing.assert_allclose(decoded.flatten()[1:], self.depth.flatten()[1:], rtol=1e-2)
+
+    def test_unsupported_formats(self):
+        png = cv2.imencode('.png', np.zeros((4, 4), dtype=np.uint16))[1].tobytes()
+        for fmt in ['32FC1; png compressed', 'bgr8; jpeg compressed bgr8', '16UC1; compressedDepth rvl']:
+            with self.assertRaises(ValueError):
+                decode_compressed_depth_msg(SimpleNamespace(format=fmt, data=png))
+
+    def test_undecodable_data(self):
+        with self.assertRaises(ValueError):
+            decode_compressed_depth_msg(SimpleNamespace(format='16UC1; png compressed', data=b'not a png'))
+
+
+if __name__ == '__main__':
+    import rosunit
+    rosunit.unitrun('voxseg', 'test_encoding', TestVoxelEncoding)
+    rosunit.unitrun('voxseg', 'test_encoding', TestDepthEncoding)